@@ -4,14 +4,18 @@ Polling client: reads Modbus TCP every second, publishes to MQTT, and raises an
 if temperature > 60C for over 5 seconds (clears below 58C for 3 seconds).
 Includes timeout/retry with exponential backoff.
 """
-import json
+import asyncio
+import socket
+import struct
 import time
+from collections import deque
 from datetime import datetime, timezone
-from typing import Optional
 
-from pymodbus.client import ModbusTcpClient
+import aiomqtt
+import numpy as np
+import orjson
+from pymodbus.client import AsyncModbusTcpClient
 from pymodbus.exceptions import ModbusIOException
-import paho.mqtt.client as mqtt
 
 MODBUS_HOST = "127.0.0.1"
 MODBUS_PORT = 5020
@@ -19,152 +23,406 @@ MODBUS_PORT = 5020
 MQTT_HOST = "127.0.0.1"
 MQTT_PORT = 1883
 TOPIC_TELE = "demo/telemetry"
+TOPIC_TELE_BATCH = "demo/telemetry/batch"
 TOPIC_ALARM = "demo/alarms"
 
+# Batch telemetry samples into one publish per BATCH_INTERVAL: fewer TCP
+# writes and PUBACK round-trips than one QoS 1 publish per sample.
+# Alarms stay unbatched (latency-critical).
+SEND_BATCH_ENABLED = True
+BATCH_INTERVAL = 0.25  # seconds
+# Oldest samples are dropped past this bound so an unreachable broker
+# cannot grow the pending buffer without limit (~4 min at 1 Hz).
+BATCH_MAX_PENDING = 240
+
 READ_TIMEOUT = 1.0  # seconds
 BASE_PERIOD = 1.0   # polling period
 MAX_BACKOFF = 30.0
+MQTT_RECONNECT_INTERVAL = 5.0  # pause between MQTT reconnect attempts
+
+# Alarm thresholds (hysteresis band)
+ALARM_HI = 60.0
+ALARM_LO = 58.0
+
+# Whole holding-register map, read in one transaction (matches the
+# simulator's HR_LEN): one Modbus round-trip amortizes TCP/ADU overhead
+# across all current and future fields.
+HR_LEN = 16
 
 # Register addresses
-ADDR_DEVICE_ID = 0
-ADDR_STATUS    = 1
-ADDR_POWER_W   = 2
-ADDR_VOLT_x10  = 3
-ADDR_CURR_x100 = 4
-ADDR_TEMP_x10  = 5
-ADDR_SOC_x10   = 6
+ADDR_DEVICE_ID  = 0
+ADDR_STATUS     = 1
+ADDR_POWER_W    = 2
+ADDR_VOLT_x10   = 3
+ADDR_CURR_x100  = 4
+ADDR_TEMP_x10   = 5
+ADDR_SOC_x10    = 6
+ADDR_SETPOINT_W = 7
+
+# Register block as big-endian 16-bit words; one precompiled Struct lets a
+# raw Modbus data payload be decoded to all HR_LEN values in a single call
+# (pymodbus responses arrive pre-decoded as ints, so this applies wherever
+# the wire bytes are handled directly).
+HR_STRUCT = struct.Struct(">%dH" % HR_LEN)
+
+def decode_hr_payload(buf, offset=0):
+    """Decode HR_LEN registers out of a raw data payload in one unpack."""
+    return HR_STRUCT.unpack_from(buf, offset)
+
+# Decoding table: (payload name, register address, divisor)
+FIELDS = [
+    ("power_w",    ADDR_POWER_W,    1),
+    ("voltage_v",  ADDR_VOLT_x10,   10),
+    ("current_a",  ADDR_CURR_x100,  100),
+    ("temp_c",     ADDR_TEMP_x10,   10),
+    ("soc_pct",    ADDR_SOC_x10,    10),
+    ("setpoint_w", ADDR_SETPOINT_W, 1),
+]
+
+# OPT_SERIALIZE_NUMPY lets the scaled NumPy values flow into orjson
+# without a .tolist() round-trip through Python floats.
+ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY
+
+# FIELDS split into parallel vectors so scaling is one SIMD divide per
+# poll instead of one interpreted float op per field. Dividing by the
+# integer divisors reproduces the baseline /10, /100 values exactly
+# (multiplying by 0.1/0.01 does not); divisor-1 fields are patched back
+# to the raw register ints so they stay integers on the wire.
+FIELD_NAMES = [name for name, _addr, _div in FIELDS]
+FIELD_ADDRS = [addr for _name, addr, _div in FIELDS]
+DIVISORS = np.array([div for _name, _addr, div in FIELDS])
+INT_FIELDS = [(name, addr) for name, addr, div in FIELDS if div == 1]
+
+def now_utc(_now=datetime.now, _utc=timezone.utc):
+    # orjson serializes datetime natively (RFC 3339), so no .isoformat() needed;
+    # default args skip two attribute lookups on the hot path
+    return _now(_utc)
+
+def iso_bytes(dt):
+    """RFC 3339 bytes straight from the datetime fields (same shape orjson
+    emits for aware UTC datetimes), skipping the isoformat() str allocation
+    and the encode on the alarm patch path."""
+    return b"%04d-%02d-%02dT%02d:%02d:%02d.%06d+00:00" % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
+        dt.microsecond)
+
+# Telemetry payload skeleton reused across iterations: the constant keys are
+# allocated once, only the hot slots are patched each poll.
+TELE_PAYLOAD = {
+    "ts": None,
+    "device_id": None,
+    "values": {},
+    "quality": "good"
+}
+
+def _alarm_template(state, threshold_key, threshold):
+    # serialized once at import; only {TS}/{DEV} get patched per transition
+    return orjson.dumps({
+        "ts": "{TS}",
+        "device_id": "{DEV}",
+        "type": "TEMP_HIGH",
+        "state": state,
+        threshold_key: threshold,
+    }).replace(b'"{DEV}"', b"{DEV}")
 
-def now_iso():
-    return datetime.now(timezone.utc).isoformat()
+# Alarm payloads are almost entirely constant, so skip dict building and
+# JSON encoding on the latency-critical transition path entirely: cache
+# the serialized bytes and patch the two variable slots in.
+RAISED_TMPL = _alarm_template("RAISED", "threshold_hi", ALARM_HI)
+CLEARED_TMPL = _alarm_template("CLEARED", "threshold_lo", ALARM_LO)
 
 class AlarmState:
-    def __init__(self, hi=60.0, lo=58.0, raise_after=5.0, clear_after=3.0):
-        self.hi = hi
-        self.lo = lo
-        self.raise_after = raise_after
-        self.clear_after = clear_after
-        self.high_since: Optional[float] = None
-        self.low_since: Optional[float] = None
+    """Hysteresis + duration alarm as sliding-window sample counters.
+
+    Instead of wall-clock "since" timestamps, keep ring buffers of the last
+    N samples and a running count: raise once n_on of the last n_on samples
+    exceeded `hi`, clear once n_off samples fell below `lo`. At
+    BASE_PERIOD=1s (n_on=5, n_off=3) this reproduces the previous
+    5 s raise / 3 s clear timing, with O(1) integer arithmetic per sample
+    and no float timestamp state to drift under sampling jitter.
+
+    Thresholds are held in integer tenths of a degree so update() compares
+    the raw temp_c_x10 register directly -- no float materialized per poll
+    and no float-boundary surprises. __slots__ drops the per-instance
+    __dict__ and makes attribute access a fixed slot lookup."""
+
+    __slots__ = ("hi_x10", "lo_x10", "n_on", "n_off",
+                 "win_on", "win_off", "on_count", "off_count", "active")
+
+    def __init__(self, hi=ALARM_HI, lo=ALARM_LO, n_on=5, n_off=3):
+        self.hi_x10 = int(hi * 10)
+        self.lo_x10 = int(lo * 10)
+        self.n_on = n_on
+        self.n_off = n_off
+        self.win_on = deque([0] * n_on, maxlen=n_on)
+        self.win_off = deque([0] * n_off, maxlen=n_off)
+        self.on_count = 0
+        self.off_count = 0
         self.active = False
 
-    def update(self, temp_c: float, ts: float):
+    def update(self, temp_x10: int):
+        # sliding sums: add the new sample, drop the one falling out
+        y_on = 1 if temp_x10 > self.hi_x10 else 0
+        y_off = 1 if temp_x10 < self.lo_x10 else 0
+        self.on_count += y_on - self.win_on[0]
+        self.off_count += y_off - self.win_off[0]
+        self.win_on.append(y_on)
+        self.win_off.append(y_off)
         if self.active:
-            # When active, look for clear condition
-            if temp_c < self.lo:
-                if self.low_since is None:
-                    self.low_since = ts
-                if ts - self.low_since >= self.clear_after:
-                    self.active = False
-                    self.low_since = None
-                    return "cleared"
-            else:
-                self.low_since = None
-        else:
-            # When inactive, look for raise condition
-            if temp_c > self.hi:
-                if self.high_since is None:
-                    self.high_since = ts
-                if ts - self.high_since >= self.raise_after:
-                    self.active = True
-                    self.high_since = None
-                    return "raised"
-            else:
-                self.high_since = None
+            if self.off_count >= self.n_off:
+                self.active = False
+                return "cleared"
+        elif self.on_count >= self.n_on:
+            self.active = True
+            return "raised"
         return None
 
-def publish_json(client, topic, payload):
-    client.publish(topic, json.dumps(payload), qos=1, retain=False)
+def tune_socket(sock):
+    """Enable TCP keepalive so a dead peer surfaces as a connection error
+    within a few seconds instead of a silent stall. The TCP_* knobs are
+    Linux-only, hence the hasattr guards."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 5)
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 2)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, 3000)
+
+def tune_modbus_socket(mb):
+    transport = getattr(mb, "transport", None)
+    sock = transport.get_extra_info("socket") if transport else None
+    if sock is not None:
+        tune_socket(sock)
+
+class FastHrReader:
+    """Raw Modbus-TCP Read Holding Registers fast path.
+
+    The request is byte-identical every poll apart from the transaction id,
+    so skip pymodbus's request/transaction/response object graph: patch the
+    tid into a precomputed 12-byte MBAP+PDU frame, write it, and decode the
+    fixed-size response with the precompiled HR_STRUCT. The poll loop falls
+    back to the pymodbus client whenever this path errors, which also
+    resyncs the stream by reopening the connection."""
+
+    # MBAP(7) + function code(1) + byte count(1) + register data
+    RESP_LEN = 9 + 2 * HR_LEN
 
-def main():
-    # MQTT
-    mqc = mqtt.Client(client_id="poller-1", clean_session=True)
-    mqc.connect(MQTT_HOST, MQTT_PORT, keepalive=30)
-    mqc.loop_start()
+    __slots__ = ("reader", "writer", "tid")
 
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.tid = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            MODBUS_HOST, MODBUS_PORT)
+        sock = self.writer.get_extra_info("socket")
+        if sock is not None:
+            tune_socket(sock)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def read(self):
+        """One Read Holding Registers transaction; returns the register tuple."""
+        self.tid = (self.tid + 1) & 0xFFFF
+        # tid, proto=0, len=6, unit=1, fc=3, addr=0, count=HR_LEN
+        self.writer.write(struct.pack(">HHHBBHH",
+                                      self.tid, 0, 6, 1, 3, 0, HR_LEN))
+        await self.writer.drain()
+        resp = await asyncio.wait_for(self.reader.readexactly(self.RESP_LEN),
+                                      READ_TIMEOUT)
+        tid, _proto, _length, _unit, fc, bc = struct.unpack_from(">HHHBBB", resp)
+        if tid != self.tid or fc != 0x03 or bc != 2 * HR_LEN:
+            raise ModbusIOException("fast read: unexpected response header")
+        return decode_hr_payload(resp, 9)
+
+async def publish_json(client, topic, payload):
+    # orjson emits bytes directly, skipping a str->bytes encode on publish
+    await client.publish(topic, orjson.dumps(payload, option=ORJSON_OPTS),
+                         qos=1, retain=False)
+
+async def publish_alarm(client, tmpl, now, device_id):
+    payload = (tmpl.replace(b'"{TS}"', b'"%s"' % iso_bytes(now))
+                   .replace(b"{DEV}", b"%d" % device_id))
+    await client.publish(TOPIC_ALARM, payload, qos=1, retain=False)
+
+async def batch_publisher(client, buf: deque):
+    """Drain the telemetry buffer every BATCH_INTERVAL and publish the
+    pending samples as a single JSON array on TOPIC_TELE_BATCH."""
+    scratch = bytearray(256)  # reused assembly buffer: grows once, then stays
+    while True:
+        await asyncio.sleep(BATCH_INTERVAL)
+        if not buf:
+            continue
+        del scratch[:]  # keeps the allocation, unlike a fresh bytearray
+        scratch += b"["
+        scratch += buf.popleft()
+        while buf:
+            scratch += b","
+            scratch += buf.popleft()
+        scratch += b"]"
+        # snapshot for paho, which may pack queued payloads lazily
+        await client.publish(TOPIC_TELE_BATCH, bytes(scratch),
+                             qos=1, retain=False)
+
+# TCP_NODELAY on the MQTT socket: our publishes are single small packets,
+# so Nagle coalescing would only add up to ~40 ms latency per publish.
+MQTT_SOCKET_OPTIONS = ((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),)
+
+async def main():
+    # MQTT (aiomqtt runs paho in-loop: no extra network thread to juggle).
+    # clean_session=False resumes the broker-side session after transient
+    # drops; 100 in-flight QoS 1 messages keeps recovery bursts from
+    # stalling behind acks. aiomqtt does not auto-reconnect the way paho's
+    # loop_start() did, so any MqttError tears the session down and we dial
+    # again after a pause.
+    while True:
+        try:
+            async with aiomqtt.Client(MQTT_HOST, port=MQTT_PORT,
+                                      client_id="poller-1",
+                                      keepalive=30, clean_session=False,
+                                      socket_options=MQTT_SOCKET_OPTIONS,
+                                      max_inflight_messages=100) as mqc:
+                await poll_loop(mqc)
+        except aiomqtt.MqttError as e:
+            print(f"[{datetime.now()}] MQTT error: {e}; "
+                  f"reconnecting in {MQTT_RECONNECT_INTERVAL:g}s")
+            await asyncio.sleep(MQTT_RECONNECT_INTERVAL)
+
+async def poll_loop(mqc):
     # Modbus
-    mb = ModbusTcpClient(MODBUS_HOST, port=MODBUS_PORT, timeout=READ_TIMEOUT)
+    mb = AsyncModbusTcpClient(MODBUS_HOST, port=MODBUS_PORT, timeout=READ_TIMEOUT)
+    fast = FastHrReader()
     backoff = 0.0
     alarm = AlarmState()
 
+    # telemetry batching: poll body produces, background task drains
+    tele_buf: deque = deque(maxlen=BATCH_MAX_PENDING)
+    batch_task = None
+    if SEND_BATCH_ENABLED:
+        batch_task = asyncio.create_task(batch_publisher(mqc, tele_buf))
+
+    async def publish_tele(payload):
+        if SEND_BATCH_ENABLED:
+            tele_buf.append(orjson.dumps(payload, option=ORJSON_OPTS))
+        else:
+            await publish_json(mqc, TOPIC_TELE, payload)
+
+    # Connect once up front; the socket then stays open across iterations
+    # and keepalive turns a dead peer into an error on the next read.
+    await mb.connect()
+    if mb.connected:
+        tune_modbus_socket(mb)
+
+    # Absolute-deadline scheduler: advancing a monotonic deadline keeps the
+    # sampling cadence phase-locked instead of letting per-iteration jitter
+    # (a slow publish, timer slack) accumulate as drift.
+    next_deadline = time.monotonic()
+
     try:
         while True:
-            start = time.time()
+            # one UTC timestamp per iteration, shared by every ts field
+            now = now_utc()
             try:
-                if not mb.connect():
-                    raise ModbusIOException("connect failed")
-
-                # read 0..9 as a block
-                rr = mb.read_holding_registers(0, 10, unit=1)
-                if rr.isError():
-                    raise ModbusIOException(str(rr))
-
-                regs = rr.registers
-                device_id = regs[ADDR_DEVICE_ID]
-                power_w = regs[ADDR_POWER_W]
-                voltage_v = regs[ADDR_VOLT_x10] / 10.0
-                current_a = regs[ADDR_CURR_x100] / 100.0
-                temp_c = regs[ADDR_TEMP_x10] / 10.0
-                soc = regs[ADDR_SOC_x10] / 10.0
+                # a dead drain task would lose telemetry silently while the
+                # deque fills: re-raise its failure into the normal paths
+                if batch_task is not None and batch_task.done():
+                    batch_task.result()
 
-                payload = {
-                    "ts": now_iso(),
-                    "device_id": device_id,
-                    "values": {
-                        "power_w": power_w,
-                        "voltage_v": voltage_v,
-                        "current_a": current_a,
-                        "temp_c": temp_c,
-                        "soc_pct": soc
-                    },
-                    "quality": "good"
-                }
-                publish_json(mqc, TOPIC_TELE, payload)
+                # fast path: static precomputed frame on a dedicated socket
+                regs = None
+                try:
+                    if fast.writer is None:
+                        await fast.connect()
+                    regs = await fast.read()
+                except (OSError, asyncio.TimeoutError,
+                        asyncio.IncompleteReadError, ModbusIOException):
+                    fast.close()  # drop the stream; pymodbus resyncs below
+
+                if regs is None:
+                    # robust fallback: full pymodbus read
+                    if not mb.connected:
+                        await mb.connect()
+                        if not mb.connected:
+                            raise ModbusIOException("connect failed")
+                        tune_modbus_socket(mb)
+                    rr = await mb.read_holding_registers(0, HR_LEN, slave=1)
+                    if rr.isError():
+                        raise ModbusIOException(str(rr))
+                    regs = rr.registers
+
+                # one tuple unpack instead of per-field subscripting
+                device_id, _status, _pw, _v10, _c100, t10, _soc10 = regs[:7]
 
-                # alarm evaluation
-                evt = alarm.update(temp_c, time.time())
+                TELE_PAYLOAD["ts"] = now
+                TELE_PAYLOAD["device_id"] = device_id
+                scaled = np.asarray(regs)[FIELD_ADDRS] / DIVISORS
+                values = dict(zip(FIELD_NAMES, scaled))
+                for name, addr in INT_FIELDS:
+                    values[name] = regs[addr]
+                TELE_PAYLOAD["values"] = values
+
+                # alarm evaluation on raw integer tenths
+                evt = alarm.update(t10)
+
+                # submit the tick's publishes in one scheduling pass so the
+                # transport can coalesce telemetry + alarm into one write
+                sends = [publish_tele(TELE_PAYLOAD)]
                 if evt == "raised":
-                    publish_json(mqc, TOPIC_ALARM, {
-                        "ts": now_iso(),
-                        "device_id": device_id,
-                        "type": "TEMP_HIGH",
-                        "state": "RAISED",
-                        "threshold_hi": alarm.hi
-                    })
+                    sends.append(publish_alarm(mqc, RAISED_TMPL, now, device_id))
                 elif evt == "cleared":
-                    publish_json(mqc, TOPIC_ALARM, {
-                        "ts": now_iso(),
-                        "device_id": device_id,
-                        "type": "TEMP_HIGH",
-                        "state": "CLEARED",
-                        "threshold_lo": alarm.lo
-                    })
+                    sends.append(publish_alarm(mqc, CLEARED_TMPL, now, device_id))
+                await asyncio.gather(*sends)
 
                 # success -> reset backoff
                 backoff = 0.0
 
+            except aiomqtt.MqttError:
+                # broker trouble: hand it to main's reconnect loop rather
+                # than trying to publish the failure over the broken session
+                raise
+
             except Exception as e:
                 # Failure handling: publish degraded quality + backoff
                 payload = {
-                    "ts": now_iso(),
+                    "ts": now,
                     "device_id": None,
                     "values": {},
                     "quality": "bad",
                     "error": str(e)
                 }
-                publish_json(mqc, TOPIC_TELE, payload)
+                await publish_tele(payload)
 
                 # exponential backoff (1,2,4,8,... max MAX_BACKOFF)
                 backoff = 1.0 if backoff == 0.0 else min(MAX_BACKOFF, backoff * 2.0)
 
-            # sleep respecting base period + backoff
-            elapsed = time.time() - start
-            sleep_time = max(0.0, BASE_PERIOD - elapsed) + backoff
-            time.sleep(sleep_time)
+            # sleep until the next absolute deadline (plus any backoff)
+            next_deadline += BASE_PERIOD + backoff
+            sleep_time = next_deadline - time.monotonic()
+            if sleep_time > 0:
+                await asyncio.sleep(sleep_time)
+            else:
+                # we overran the period: resync rather than bursting
+                next_deadline = time.monotonic()
 
     finally:
-        mqc.loop_stop()
-        mqc.disconnect()
+        fast.close()
+        if batch_task is not None:
+            batch_task.cancel()
         mb.close()
 
 if __name__ == "__main__":
-    main()
+    try:
+        # libuv-backed event loop: fewer syscalls per socket op. Optional --
+        # the default selector loop is fine at a single device.
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(main())
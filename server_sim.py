@@ -4,10 +4,22 @@ Modbus TCP inverter/BMS simulator using pymodbus.
 Listens at 0.0.0.0:5020 and updates registers every second.
 """
 import asyncio
-import random
-import threading
-import time
 from datetime import datetime
+
+import numpy as np
+
+try:
+    # Optional: LLVM-compiles the per-tick register math. The simulator is
+    # fine without it at one device; it pays off when fanning out to many.
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        def wrap(func):
+            return func
+        return wrap
+
 from pymodbus.server import StartTcpServer, ModbusTcpServer
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSequentialDataBlock
 from pymodbus.device import ModbusDeviceIdentification
@@ -22,21 +34,34 @@ temp_high_mode = [False]
 high_start_time = [None]
 
 class UpdatingDataBlock(ModbusSequentialDataBlock):
+    """Holding registers backed by a NumPy uint16 array (SoA layout).
+
+    Lock-free on CPython: readers snapshot the current array reference and
+    slice it, while writers build a fresh array and publish it with one
+    attribute assignment -- an atomic pointer swap under the GIL, so a
+    reader never observes a half-written tick. (CPython-only guarantee;
+    a free-threaded build would need the lock back.)"""
+
     def __init__(self, address, values):
         super().__init__(address, values)
-        self.lock = threading.Lock()
+        self.regs = np.array(values, dtype=np.uint16)
+
+    def getValues(self, address, count=1):
+        regs = self.regs  # snapshot; the swap below is atomic
+        return regs[address:address + count].tolist()
 
-    def set_reg(self, addr, value):
-        with self.lock:
-            super().setValues(addr, [value])
+    def setValues(self, address, values):
+        if isinstance(values, int):
+            values = [values]
+        new = self.regs.copy()
+        new[address:address + len(values)] = values
+        self.regs = new  # atomic reference publish
 
-    def get_reg(self, addr):
-        with self.lock:
-            return super().getValues(addr, 1)[0]
+    def read_all(self):
+        return self.regs.copy()
 
-    def get_regs(self, addr, count):
-        with self.lock:
-            return super().getValues(addr, count)
+    def update_all(self, new_regs):
+        self.regs = np.asarray(new_regs, dtype=np.uint16)  # atomic reference publish
 
 def make_context():
     # Init holding registers with defaults
@@ -56,52 +81,79 @@ def make_context():
 
 
 
+@njit(cache=True)
+def tick(regs, t, noise):
+    """One simulator tick: mutate the uint16 register copy in place.
+
+    Pure scalar/NumPy math so numba can compile it in nopython mode;
+    `noise` is four uniform [0, 1) draws supplying all randomness."""
+    sp = int(regs[7])
+    pw = int(regs[2])
+    delta = sp - pw
+    if delta > 50:
+        delta = 50
+    elif delta < -50:
+        delta = -50
+    if abs(delta) > 10:
+        pw += int(delta * 0.3)
+    else:
+        pw += int(noise[0] * 11) - 5
+    if pw < 0:
+        pw = 0
+    elif pw > 5000:
+        pw = 5000
+    regs[2] = pw
+
+    v = 2300 + int(noise[1] * 31) - 15
+    regs[3] = v
+
+    v10 = v / 10.0
+    if v10 < 1.0:
+        v10 = 1.0
+    ia = int(pw / v10 * 100)
+    if ia < 0:
+        ia = 0
+    elif ia > 2000:
+        ia = 2000
+    regs[4] = ia
+
+    # 20 saniyelik döngü: ilk 10 sn yüksek, sonraki 10 sn düşük sıcaklık
+    cycle = int((t // 10) % 2)
+    if cycle == 0:
+        temp_target = 65.0 + (noise[2] - 0.5)
+    else:
+        temp_target = 40.0 + (noise[2] - 0.5)
+
+    temp = regs[5] / 10.0
+    temp = temp * 0.8 + temp_target * 0.2
+    regs[5] = int(temp * 10)
+
+    soc = regs[6] / 10.0
+    soc += (noise[3] - 0.5) * 0.4
+    if soc < 0.0:
+        soc = 0.0
+    elif soc > 100.0:
+        soc = 100.0
+    regs[6] = int(soc * 10)
+
+    regs[1] = 0b00000001  # status_bits (running)
+
+
 # Sıcaklık periyodik olarak yükselip düşer
-def updater(block: UpdatingDataBlock, interval=1.0):
+async def updater(block: UpdatingDataBlock, interval=1.0):
+    rng = np.random.default_rng()
     t = 0.0
     while True:
         try:
-            sp = block.get_reg(7)
-            pw = block.get_reg(2)
-            delta = max(-50, min(50, sp - pw))
-            if abs(delta) > 10:
-                pw += int(delta * 0.3)
-            else:
-                pw += random.randint(-5, 5)
-            pw = max(0, min(5000, pw))
-            block.set_reg(2, pw)
-
-            v = 2300 + random.randint(-15, 15)
-            block.set_reg(3, v)
-
-            current_a = pw / max(1, v/10)
-            ia = int(max(0, min(2000, current_a * 100)))
-            block.set_reg(4, ia)
-
-            # 20 saniyelik döngü: ilk 10 sn yüksek, sonraki 10 sn düşük sıcaklık
-            cycle = int((t // 10) % 2)
-            if cycle == 0:
-                temp_target = 65 + random.uniform(-0.5, 0.5)
-            else:
-                temp_target = 40 + random.uniform(-0.5, 0.5)
-
-            temp = block.get_reg(5) / 10.0
-            temp = temp * 0.8 + temp_target * 0.2
-            block.set_reg(5, int(temp * 10))
-
-            soc = block.get_reg(6) / 10.0
-            soc += random.uniform(-0.2, 0.2)
-            soc = min(100.0, max(0.0, soc))
-            block.set_reg(6, int(soc * 10))
-
-            status = 0b00000001
-            block.set_reg(1, status)
+            regs = block.read_all()       # private copy of the register block
+            tick(regs, t, rng.random(4))  # compiled hot path
+            block.update_all(regs)        # publish the whole tick at once
 
             t += interval
-            time.sleep(interval)
+            await asyncio.sleep(interval)
         except Exception as e:
             print(f"[{datetime.now()}] updater error: {e}")
-            time.sleep(interval)
+            await asyncio.sleep(interval)
 
 
 async def run_server():
@@ -115,8 +167,7 @@ async def run_server():
     identity.ModelName = "SIM-INV-01"
     identity.MajorMinorRevision = "1.0"
 
-    th = threading.Thread(target=updater, args=(block,), daemon=True)
-    th.start()
+    asyncio.create_task(updater(block))
 
     print(f"Starting Modbus TCP simulator at {HOST}:{PORT}")
     server = ModbusTcpServer(context, identity=identity, address=(HOST, PORT))